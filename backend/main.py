@@ -1,27 +1,39 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse, Response
 from pathlib import Path
+import asyncio
 import shutil
-import uuid
-from typing import Optional
+import tempfile
+import time
+from typing import Optional, Union
 import logging
-from pdf2image import convert_from_path
+import aiofiles
+import numpy as np
 from PIL import Image
 import os
 
-from model_inference import get_extractor
+try:
+    import fitz  # PyMuPDF: in-process PDF rendering, no Poppler subprocess
+    HAS_PYMUPDF = True
+except ImportError:
+    from pdf2image import convert_from_path
+    HAS_PYMUPDF = False
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+from model_inference import get_extractor, get_cached_crop
+
+# Configure logging; default to WARNING so per-request chatter stays off
+# the hot path, override with LOG_LEVEL=INFO/DEBUG when diagnosing
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"))
 logger = logging.getLogger(__name__)
 
 # Create FastAPI app
 app = FastAPI(
     title="Passport Extraction API",
     description="Extract passport information from PDF or image files using deep learning",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse  # orjson serializes the float-heavy results in C
 )
 
 # Configure CORS
@@ -33,55 +45,183 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create upload and extracted directories
+# Create upload directory
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-EXTRACTED_DIR = Path("uploads/extracted")
-EXTRACTED_DIR.mkdir(parents=True, exist_ok=True)
+# Supported file extensions
+ALLOWED_EXTENSIONS = frozenset({".pdf", ".jpg", ".jpeg", ".png", ".tiff", ".bmp"})
 
-# Mount static files for extracted images
-app.mount("/extracted", StaticFiles(directory=str(EXTRACTED_DIR)), name="extracted")
+# Upload streaming: 1 MiB chunks, 50 MiB cap
+UPLOAD_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_SIZE = 50 << 20
 
-# Supported file extensions
-ALLOWED_EXTENSIONS = {".pdf", ".jpg", ".jpeg", ".png", ".tiff", ".bmp"}
+# Background cleanup: prune stale uploads every 10 minutes, keep 1 hour.
+# Manual cleanup still keeps anything younger than MANUAL_PRUNE_AGE so
+# in-flight request directories are never swept
+CLEANUP_INTERVAL = 600
+UPLOAD_TTL = 3600
+MANUAL_PRUNE_AGE = 300
+
+# Set by /cleanup to trigger an immediate full prune
+_cleanup_requested = asyncio.Event()
+
+
+def _prune_uploads(max_age: float = UPLOAD_TTL) -> int:
+    """
+    Delete entries in UPLOAD_DIR older than max_age seconds.
+
+    Handles both stray files and per-request temp directories left
+    behind by a crashed worker.
+    """
+    count = 0
+    now = time.time()
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime <= max_age:
+                    continue
+                if entry.is_file():
+                    os.unlink(entry.path)
+                elif entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                count += 1
+            except OSError as e:
+                logger.warning(f"Error cleaning up {entry.path}: {e}")
+    return count
+
+
+async def _janitor():
+    """
+    Periodically prune stale uploads off the request path.
+
+    Deletion runs on the thread pool so a large directory never blocks
+    the event loop; /cleanup wakes the loop early for a full prune.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(_cleanup_requested.wait(), timeout=CLEANUP_INTERVAL)
+            # Manual trigger: prune aggressively, but never recent entries --
+            # they may be live per-request temp directories
+            max_age = MANUAL_PRUNE_AGE
+        except asyncio.TimeoutError:
+            max_age = UPLOAD_TTL
+        _cleanup_requested.clear()
+
+        removed = await run_in_threadpool(_prune_uploads, max_age)
+        if removed:
+            logger.debug(f"Janitor removed {removed} stale uploads")
+
+
+async def save_upload(file: UploadFile, dest: Path):
+    """
+    Stream an upload to disk in chunks.
+
+    Writes bytes as they arrive instead of spooling the whole file in
+    memory, and rejects uploads larger than MAX_UPLOAD_SIZE.
+    """
+    total = 0
+    async with aiofiles.open(dest, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            total += len(chunk)
+            if total > MAX_UPLOAD_SIZE:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File too large (max {MAX_UPLOAD_SIZE >> 20} MB)"
+                )
+            await out.write(chunk)
+
+
+@app.on_event("startup")
+async def startup():
+    """Load and warm up the model, then start the micro-batching loop."""
+    extractor = get_extractor()
+    # One dummy inference so the first real request doesn't pay model-load
+    # and cuDNN autotune latency
+    await run_in_threadpool(extractor.warmup)
+    extractor.start_batching()
+    app.state.janitor = asyncio.create_task(_janitor())
+
+
+def file_extension_of(filename: str) -> str:
+    """Return the lowercased extension (with dot) without building a Path."""
+    i = filename.rfind(".")
+    return filename[i:].lower() if i >= 0 else ""
 
 
 def is_allowed_file(filename: str) -> bool:
     """Check if file extension is allowed."""
-    return Path(filename).suffix.lower() in ALLOWED_EXTENSIONS
+    return file_extension_of(filename) in ALLOWED_EXTENSIONS
+
+
+def render_pdf_page(pdf_path: Path, page_number: int = 1, target_long_side: int = 1280) -> np.ndarray:
+    """
+    Render a PDF page to a numpy array with PyMuPDF.
+
+    Renders at the minimum zoom that puts the page's long side at
+    target_long_side pixels, so we never rasterize more pixels than the
+    detector needs. No intermediate PNG is written.
+
+    Args:
+        pdf_path: Path to PDF file
+        page_number: Page number to render (1-indexed)
+        target_long_side: Pixel size of the rendered page's long side
+
+    Returns:
+        BGR image array ready for extraction
+    """
+    try:
+        doc = fitz.open(pdf_path)
+        try:
+            if not 1 <= page_number <= doc.page_count:
+                raise ValueError(f"Page {page_number} out of range (1-{doc.page_count})")
+
+            page = doc[page_number - 1]
+            zoom = target_long_side / max(page.rect.width, page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
+
+            logger.debug(f"Rendered PDF page {page_number} at {pix.w}x{pix.h}")
+            # PyMuPDF renders RGB; downstream expects OpenCV's BGR order
+            return np.ascontiguousarray(image[:, :, ::-1])
+        finally:
+            doc.close()
+
+    except Exception as e:
+        logger.error(f"Error rendering PDF page: {e}")
+        raise HTTPException(status_code=500, detail=f"PDF conversion failed: {str(e)}")
 
 
 def convert_pdf_to_image(pdf_path: Path, page_number: int = 1) -> Path:
     """
-    Convert PDF to image.
-    
+    Convert PDF to image via pdf2image (fallback when PyMuPDF is missing).
+
     Args:
         pdf_path: Path to PDF file
         page_number: Page number to extract (1-indexed)
-        
+
     Returns:
         Path to converted image
     """
     try:
-        # Convert PDF to images
+        # Convert PDF to images; JPEG output avoids Poppler's slow PNG encode
         images = convert_from_path(
             pdf_path,
             first_page=page_number,
             last_page=page_number,
-            dpi=300
+            dpi=300,
+            fmt="jpeg"
         )
-        
+
         if not images:
             raise ValueError(f"No images found in PDF page {page_number}")
-        
-        # Save as PNG
-        image_path = pdf_path.with_suffix(".png")
-        images[0].save(image_path, "PNG")
-        
-        logger.info(f"Converted PDF to image: {image_path}")
+
+        image_path = pdf_path.with_suffix(".jpg")
+        images[0].save(image_path, "JPEG")
+
+        logger.debug(f"Converted PDF to image: {image_path}")
         return image_path
-        
+
     except Exception as e:
         logger.error(f"Error converting PDF to image: {e}")
         raise HTTPException(status_code=500, detail=f"PDF conversion failed: {str(e)}")
@@ -133,84 +273,76 @@ async def extract_passport(
     Returns:
         JSON response with extracted passport fields
     """
-    # Validate file
-    if not is_allowed_file(file.filename):
+    # Validate file; the extension is computed once and reused below
+    file_extension = file_extension_of(file.filename)
+    if file_extension not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=400,
-            detail=f"File type not allowed. Supported: {', '.join(ALLOWED_EXTENSIONS)}"
+            detail=f"File type not allowed. Supported: {', '.join(sorted(ALLOWED_EXTENSIONS))}"
         )
-    
-    # Generate unique filename
-    file_id = str(uuid.uuid4())
-    file_extension = Path(file.filename).suffix.lower()
-    upload_path = UPLOAD_DIR / f"{file_id}{file_extension}"
-    
-    try:
-        # Save uploaded file
-        with upload_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        logger.info(f"File uploaded: {upload_path}")
-        
-        # Convert PDF to image if needed
-        if file_extension == ".pdf":
-            image_path = convert_pdf_to_image(upload_path, page_number)
-        else:
-            image_path = upload_path
-        
-        # Extract passport fields (photo and signature)
-        extractor = get_extractor()
-        results = extractor.extract_fields(str(image_path))
-        
-        # Convert file paths to URLs for frontend access
-        if "extracted_images" in results:
-            for field_name, field_data in results["extracted_images"].items():
-                # Convert absolute path to relative URL
-                file_path = Path(field_data["path"])
-                field_data["url"] = f"/extracted/{file_path.name}"
-        
-        # Add metadata
-        results["metadata"] = {
-            "filename": file.filename,
-            "file_type": file_extension,
-            "page_number": page_number if file_extension == ".pdf" else None
-        }
-        
-        return JSONResponse(content=results)
-        
-    except Exception as e:
-        logger.error(f"Error processing file: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-        
-    finally:
-        # Cleanup uploaded files (but keep extracted images)
+
+    # Keep all per-request artifacts (upload plus any converted image) in
+    # one temp directory; the whole tree is removed when the request ends,
+    # with no path arithmetic to guess what the converter produced
+    with tempfile.TemporaryDirectory(dir=UPLOAD_DIR) as tmp_dir:
+        upload_path = Path(tmp_dir) / f"upload{file_extension}"
+
         try:
-            if upload_path.exists():
-                upload_path.unlink()
+            # Stream uploaded file to disk without blocking the event loop
+            await save_upload(file, upload_path)
+
+            logger.debug(f"File uploaded: {upload_path}")
+
+            # Convert PDF to image if needed; PyMuPDF hands back an
+            # in-memory array with no intermediate file. Rendering is
+            # CPU-bound, so it runs on the thread pool
+            image: Union[str, np.ndarray]
             if file_extension == ".pdf":
-                image_path = upload_path.with_suffix(".png")
-                if image_path.exists():
-                    image_path.unlink()
+                if HAS_PYMUPDF:
+                    image = await run_in_threadpool(render_pdf_page, upload_path, page_number)
+                else:
+                    image = str(await run_in_threadpool(convert_pdf_to_image, upload_path, page_number))
+            else:
+                image = str(upload_path)
+
+            # Extract passport fields (photo and signature); concurrent
+            # requests are batched into a single forward pass
+            extractor = get_extractor()
+            results = await extractor.extract_fields_async(image)
+
+            # Add metadata
+            results["metadata"] = {
+                "filename": file.filename,
+                "file_type": file_extension,
+                "page_number": page_number if file_extension == ".pdf" else None
+            }
+
+            return results
+
+        except HTTPException:
+            raise
+
         except Exception as e:
-            logger.warning(f"Error cleaning up files: {e}")
+            logger.error(f"Error processing file: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/extracted/{key}.jpg")
+async def get_extracted_image(key: str):
+    """Serve an extracted crop from the in-memory cache."""
+    data = get_cached_crop(key)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Extracted image not found")
+    return Response(content=data, media_type="image/jpeg")
 
 
 @app.delete("/cleanup")
 async def cleanup_uploads():
-    """Clean up all uploaded files (for maintenance)."""
-    try:
-        count = 0
-        for file_path in UPLOAD_DIR.glob("*"):
-            if file_path.is_file():
-                file_path.unlink()
-                count += 1
-        
-        return {
-            "message": f"Cleaned up {count} files",
-            "count": count
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    """Request an immediate prune of uploaded files (for maintenance)."""
+    # Signal the janitor instead of deleting inline, so a large directory
+    # never blocks this request
+    _cleanup_requested.set()
+    return {"message": "Cleanup scheduled"}
 
 
 if __name__ == "__main__":